@@ -1,31 +1,96 @@
+from collections import OrderedDict
+
 from dash import html, dcc, Input, Output, State
+import numpy as np
 import pandas as pd
-import plotly.graph_objs as go
 from dash.exceptions import PreventUpdate
-from io import StringIO
 import dash
 
-def calculate_monthly_stats(data, exclude_single_bookings=False):
-    """Calculate monthly statistics from the data"""
-    data = data.copy()
-    data["YearMonth"] = data["Start_Date_time"].dt.to_period("M")
-    
-    # Exclude "Self Practice" classes
-    data = data[~data["Class_Name"].str.contains("Self Practice", case=False, na=False)]
-    
-    booking_frequencies = data.groupby(["YearMonth", "Id_Person"]).size().reset_index(name="Bookings")
+from cache import get_cached_dataframe
+from utils import send_excel
+
+# Static portions of the two figure layouts; the callback only fills in the
+# dynamic title
+FIG1_LAYOUT = dict(
+    yaxis=dict(title="Mean/Median Value", side="left"),
+    yaxis2=dict(title="Total Bookings", side="right", overlaying="y"),
+    legend=dict(orientation="h", yanchor="bottom", y=-0.3, xanchor="center", x=0.5),
+    height=400,
+    margin=dict(b=100)  # Increased bottom margin to accommodate legend
+)
+
+FIG2_LAYOUT = dict(
+    yaxis=dict(title="Number of Students"),
+    height=400,
+    margin=dict(b=50)
+)
+
+def calculate_monthly_stats(data, exclude_single_bookings=False, start_period=None, end_period=None):
+    """Calculate monthly statistics from the data
+
+    Expects the upload-time preprocessing from store_shared_data: a YearMonth
+    column and "Self Practice" rows already removed.
+    """
+    # Slice the requested window first so the aggregation only sees rows that
+    # end up on the chart
+    if start_period and end_period:
+        data = data[
+            (data["YearMonth"] >= pd.Period(start_period, freq="M")) &
+            (data["YearMonth"] <= pd.Period(end_period, freq="M"))
+        ]
+
+    # Count bookings per (month, person) in one pass over factorized integer
+    # codes instead of a hash groupby over the raw key columns
+    month_codes, months = pd.factorize(data["YearMonth"], sort=True)
+    person_codes, persons = pd.factorize(data["Id_Person"])
+    # factorize encodes missing keys (NaT months, blank ids) as -1; drop them
+    # like the baseline groupby did instead of feeding bincount negative bins
+    valid = (month_codes >= 0) & (person_codes >= 0)
+    if not valid.all():
+        month_codes = month_codes[valid]
+        person_codes = person_codes[valid]
+    counts = np.bincount(month_codes * len(persons) + person_codes,
+                         minlength=len(months) * len(persons))
+    occupied = np.flatnonzero(counts)
+    booking_frequencies = pd.DataFrame({
+        "YearMonth": months.take(occupied // len(persons)),
+        "Id_Person": persons.take(occupied % len(persons)),
+        "Bookings": counts[occupied]
+    })
     
     if exclude_single_bookings:
         booking_frequencies = booking_frequencies[booking_frequencies["Bookings"] > 1]
     
-    # Calculate statistics
-    stats = booking_frequencies.groupby("YearMonth")["Bookings"].agg(["mean", "median"]).reset_index()
-    stats["Total"] = booking_frequencies.groupby("YearMonth")["Bookings"].sum().values
-    stats["Students"] = booking_frequencies.groupby("YearMonth")["Id_Person"].nunique().values
+    # Calculate all statistics in a single groupby pass; booking_frequencies
+    # has one row per (YearMonth, Id_Person), so a plain count equals nunique
+    stats = booking_frequencies.groupby("YearMonth").agg(
+        mean=("Bookings", "mean"),
+        median=("Bookings", "median"),
+        Total=("Bookings", "sum"),
+        Students=("Id_Person", "count")
+    ).reset_index()
     stats["YearMonth"] = stats["YearMonth"].astype(str)
     
     return stats
 
+# Small LRU of computed stats tables so an Execute followed by an Export (or a
+# repeat Execute) reuses one aggregation instead of recomputing it
+_STATS_CACHE = OrderedDict()
+_STATS_CACHE_SIZE = 16
+
+def cached_monthly_stats(df, stored_key, exclude_single_bookings, start_period, end_period):
+    """Memoized calculate_monthly_stats keyed on the upload and inputs"""
+    key = (stored_key, bool(exclude_single_bookings), start_period, end_period)
+    if key in _STATS_CACHE:
+        _STATS_CACHE.move_to_end(key)
+        return _STATS_CACHE[key]
+
+    stats = calculate_monthly_stats(df, exclude_single_bookings, start_period, end_period)
+    _STATS_CACHE[key] = stats
+    if len(_STATS_CACHE) > _STATS_CACHE_SIZE:
+        _STATS_CACHE.popitem(last=False)
+    return stats
+
 def create_monthly_stat_layout(show_upload=True):
     """Create the layout for monthly statistics analysis"""
     return html.Div([
@@ -86,7 +151,6 @@ def create_monthly_stat_layout(show_upload=True):
         ], id='results-section-stats', style={'display': 'none'}),
         
         # Store components
-        dcc.Store(id='chart-data-stats'),
         dcc.Download(id="download-stats-xlsx"),
         dcc.Loading(
             id="loading-stats",
@@ -109,9 +173,9 @@ def register_monthly_stat_callbacks(app):
     def update_period_dropdowns(stored_data):
         if not stored_data:
             return [], [], None, None, {'display': 'none'}
-            
-        df = pd.read_json(StringIO(stored_data['data']), orient='split')
-        periods = sorted(df["Start_Date_time"].dt.to_period("M").astype(str).unique())
+
+        # Period list is precomputed at upload time
+        periods = stored_data['periods']
         options = [{'label': p, 'value': p} for p in periods]
         
         return options, options, periods[0], periods[-1], {'display': 'block'}
@@ -121,8 +185,7 @@ def register_monthly_stat_callbacks(app):
          Output('students-graph', 'figure'),
          Output('results-section-stats', 'style'),
          Output('status-message-stats', 'children'),
-         Output('status-message-stats', 'className'),
-         Output('chart-data-stats', 'data')],
+         Output('status-message-stats', 'className')],
         Input('execute-stats-btn', 'n_clicks'),
         [State('shared-stored-data', 'data'),
          State('start-period-stats', 'value'),
@@ -132,116 +195,68 @@ def register_monthly_stat_callbacks(app):
     def update_graphs(n_clicks, stored_data, start_period, end_period, exclude_single_bookings):
         if not n_clicks or not stored_data:
             raise PreventUpdate
-            
+
+        df = get_cached_dataframe(stored_data)
+        if df is None:
+            raise PreventUpdate
+
         try:
-            # Load and process data
-            df = pd.read_json(StringIO(stored_data['data']), orient='split')
-            stats = calculate_monthly_stats(df, exclude_single_bookings)
-            
-            # Filter by date range
-            filtered_stats = stats[
-                (stats["YearMonth"] >= start_period) & 
-                (stats["YearMonth"] <= end_period)
-            ]
-            
-            # Create main statistics figure
-            fig1 = go.Figure()
-            
-            # Add mean and median lines
-            fig1.add_trace(go.Scatter(
-                x=filtered_stats["YearMonth"],
-                y=filtered_stats["mean"],
-                name="Mean",
-                mode="lines+markers+text",
-                text=[f"{x:.2f}" for x in filtered_stats["mean"]],
-                textposition="top center",
-                textfont=dict(color='black')
-            ))
-            
-            fig1.add_trace(go.Scatter(
-                x=filtered_stats["YearMonth"],
-                y=filtered_stats["median"],
-                name="Median",
-                mode="lines+markers+text",
-                text=[f"{x:.2f}" for x in filtered_stats["median"]],
-                textposition="bottom center",
-                textfont=dict(color='black')
-            ))
-            
-            # Add total bookings bars
-            fig1.add_trace(go.Bar(
-                x=filtered_stats["YearMonth"],
-                y=filtered_stats["Total"],
-                name="Total Bookings",
-                opacity=0.3,
-                text=filtered_stats["Total"].astype(int),
-                textposition="outside",
-                textfont=dict(color='black'),
-                yaxis="y2"
-            ))
-            
-            # Update layout for main figure
-            title_suffix = " (Excluding Single Bookings)" if exclude_single_bookings else ""
-            fig1.update_layout(
-                title=dict(
-                    text=f"Monthly Booking Statistics{title_suffix}",
-                    x=0.5,
-                    xanchor='center',
-                    font=dict(size=20)
-                ),
-                yaxis=dict(
-                    title="Mean/Median Value",
-                    side="left"
-                ),
-                yaxis2=dict(
-                    title="Total Bookings",
-                    side="right",
-                    overlaying="y"
-                ),
-                legend=dict(
-                    orientation="h",
-                    yanchor="bottom",
-                    y=-0.3,
-                    xanchor="center",
-                    x=0.5
-                ),
-                height=400,
-                margin=dict(b=100)  # Increased bottom margin to accommodate legend
-            )
-            
-            # Create students figure
-            fig2 = go.Figure()
-            
-            fig2.add_trace(go.Bar(
-                x=filtered_stats["YearMonth"],
-                y=filtered_stats["Students"],
-                text=filtered_stats["Students"].astype(int),
-                textposition="outside",
-                textfont=dict(color='black')
-            ))
-            
-            # Update layout for students figure
-            fig2.update_layout(
-                title=dict(
-                    text="Number of Students Per Month",
-                    x=0.5,
-                    xanchor='center',
-                    font=dict(size=20)
-                ),
-                yaxis_title="Number of Students",
-                height=400,
-                margin=dict(b=50)
+            # Process data; the range filter happens before aggregation
+            filtered_stats = cached_monthly_stats(
+                df, stored_data['key'], exclude_single_bookings, start_period, end_period
             )
+
+            # Convert plotted columns to numpy once; marker labels are
+            # formatted with numpy's C-level formatter rather than per-row
+            # Python f-strings
+            months_x = filtered_stats["YearMonth"].to_numpy()
+            means = filtered_stats["mean"].to_numpy(dtype=np.float64)
+            medians = filtered_stats["median"].to_numpy(dtype=np.float64)
+            totals = filtered_stats["Total"].to_numpy(dtype=np.int64)
+            students = filtered_stats["Students"].to_numpy(dtype=np.int64)
+
+            # Build figures as plain dicts over the module-level layout
+            # templates; Dash accepts them as-is and skips go.Figure validation
+            title_suffix = " (Excluding Single Bookings)" if exclude_single_bookings else ""
+            fig1 = {
+                'data': [
+                    dict(type='scatter', x=months_x, y=means, name="Mean",
+                         mode="lines+markers+text", text=np.char.mod('%.2f', means),
+                         textposition="top center", textfont=dict(color='black')),
+                    dict(type='scatter', x=months_x, y=medians, name="Median",
+                         mode="lines+markers+text", text=np.char.mod('%.2f', medians),
+                         textposition="bottom center", textfont=dict(color='black')),
+                    dict(type='bar', x=months_x, y=totals, name="Total Bookings",
+                         opacity=0.3, text=totals, textposition="outside",
+                         textfont=dict(color='black'), yaxis="y2")
+                ],
+                'layout': dict(
+                    FIG1_LAYOUT,
+                    title=dict(text=f"Monthly Booking Statistics{title_suffix}",
+                               x=0.5, xanchor='center', font=dict(size=20))
+                )
+            }
+
+            fig2 = {
+                'data': [
+                    dict(type='bar', x=months_x, y=students, text=students,
+                         textposition="outside", textfont=dict(color='black'))
+                ],
+                'layout': dict(
+                    FIG2_LAYOUT,
+                    title=dict(text="Number of Students Per Month",
+                               x=0.5, xanchor='center', font=dict(size=20))
+                )
+            }
             
             return (
-                fig1, fig2, {'display': 'block'}, 
-                "Analysis completed successfully", "text-green-600",
-                filtered_stats.to_json(date_format='iso', orient='split')
+                fig1, fig2, {'display': 'block'},
+                "Analysis completed successfully", "text-green-600"
             )
             
         except Exception as e:
             return (dash.no_update, dash.no_update, {'display': 'none'}, 
-                    f"Error: {str(e)}", "text-red-600", None)
+                    f"Error: {str(e)}", "text-red-600")
     @app.callback(
         Output("download-stats-xlsx", "data"),
         Input("export-stats-btn", "n_clicks"),
@@ -254,22 +269,20 @@ def register_monthly_stat_callbacks(app):
     def export_chart_data(n_clicks, stored_data, start_period, end_period, exclude_single_bookings):
         if not n_clicks or not stored_data:
             raise PreventUpdate
-        
+
+        df = get_cached_dataframe(stored_data)
+        if df is None:
+            raise PreventUpdate
+
         try:
-            df = pd.read_json(StringIO(stored_data['data']), orient='split')
-            stats = calculate_monthly_stats(df, exclude_single_bookings)
-            
-            # Filter by date range
-            filtered_stats = stats[
-                (stats["YearMonth"] >= start_period) & 
-                (stats["YearMonth"] <= end_period)
-            ]
-            
-            return dcc.send_data_frame(
-                filtered_stats.to_excel,
+            filtered_stats = cached_monthly_stats(
+                df, stored_data['key'], exclude_single_bookings, start_period, end_period
+            )
+
+            return send_excel(
+                filtered_stats,
                 "monthly_booking_statistics.xlsx",
-                sheet_name="Monthly Statistics",
-                index=False
+                sheet_name="Monthly Statistics"
             )
         except Exception:
             raise PreventUpdate
\ No newline at end of file
@@ -1,6 +1,9 @@
 from dash import Dash, html, dcc, Input, Output, State
 import dash_bootstrap_components as dbc
+import hashlib
+import pandas as pd
 import os
+from cache import cache, set_cached_dataframe
 from layouts import create_layout
 from callbacks import register_callbacks
 from monthly_user_booking_analysis import (
@@ -34,6 +37,9 @@ app = Dash(__name__,
 # Add this line for Gunicorn
 server = app.server
 
+# Initialize the server-side cache used for the parsed upload
+cache.init_app(server)
+
 # Define the main app layout with navigation and shared file upload
 app.layout = html.Div([
     # File Upload Section (Shared)
@@ -98,9 +104,36 @@ def store_shared_data(contents, filename):
     df, error = parse_contents(contents)
     if error:
         return None, f"Error: {error}", "mt-2 text-red-600", ""
-    
+
+    # Derive the month bucket once and drop "Self Practice" rows up front;
+    # every analysis excludes them
+    df['YearMonth'] = df['Start_Date_time'].dt.to_period('M')
+    if 'Class_Name' in df.columns:
+        # regex=False dispatches to the C substring search; "Self Practice"
+        # is a literal, not a pattern
+        df = df[~df['Class_Name'].str.contains('Self Practice', case=False, na=False, regex=False)].copy()
+        df['Class_Name'] = df['Class_Name'].astype('category')
+    # Categorical Id_Person lets downstream groupbys hash int codes instead
+    # of the raw values
+    df['Id_Person'] = df['Id_Person'].astype('category')
+    for col in ('Cateory', 'FirstName', 'Teacher'):
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    # Dedupe before stringifying: N rows collapse to a handful of months
+    # before any str conversion happens
+    periods = pd.PeriodIndex(df['YearMonth'].unique()).sort_values().astype(str).tolist()
+
+    # Keep the cached frame sorted by timestamp so window filters can slice
+    # with searchsorted instead of scanning a boolean mask
+    df = df.sort_values('Start_Date_time', ignore_index=True)
+
+    # Cache the parsed DataFrame server-side so callbacks only need the key
+    key = hashlib.md5(contents.encode()).hexdigest()
+    set_cached_dataframe(key, df)
+
     return {
-        'data': df.to_json(date_format='iso', orient='split'),
+        'key': key,
+        'periods': periods,
         'filename': filename
     }, f"File uploaded: {filename}", "mt-2 text-green-600", ""
 
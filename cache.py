@@ -0,0 +1,38 @@
+import base64
+import io
+
+from flask_caching import Cache
+from pyarrow import feather
+
+# Server-side cache for the parsed upload. Callbacks fetch the DataFrame by the
+# key kept in 'shared-stored-data' instead of re-parsing JSON on every interaction.
+cache = Cache(config={
+    'CACHE_TYPE': 'FileSystemCache',
+    'CACHE_DIR': '/tmp/dash',
+    'CACHE_DEFAULT_TIMEOUT': 0
+})
+
+def set_cached_dataframe(key, df):
+    """Cache a DataFrame as Arrow Feather IPC bytes under the given key"""
+    buf = io.BytesIO()
+    feather.write_feather(df, buf, compression='zstd')
+    cache.set(key, buf.getvalue())
+
+def dataframe_to_store(df):
+    """Encode a DataFrame as base64 Feather bytes for a dcc.Store payload"""
+    buf = io.BytesIO()
+    feather.write_feather(df, buf)
+    return base64.b64encode(buf.getvalue()).decode()
+
+def dataframe_from_store(payload):
+    """Decode a DataFrame encoded with dataframe_to_store"""
+    return feather.read_feather(io.BytesIO(base64.b64decode(payload)))
+
+def get_cached_dataframe(stored_data):
+    """Fetch the parsed DataFrame for the upload referenced by stored_data"""
+    if not stored_data or 'key' not in stored_data:
+        return None
+    payload = cache.get(stored_data['key'])
+    if payload is None:
+        return None
+    return feather.read_feather(io.BytesIO(payload))
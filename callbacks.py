@@ -1,15 +1,16 @@
-from dash import Input, Output, State, dash_table, html, dcc
+from dash import Input, Output, State, dash_table, html
 from dash.exceptions import PreventUpdate
 from dash import ALL
+import numpy as np
 import plotly.graph_objects as go
-import pandas as pd
-from io import StringIO
 import dash
 
+from cache import get_cached_dataframe
 from utils import (
-    create_frequency_table, 
-    get_monthly_selector, 
-    get_range_selector
+    create_frequency_table,
+    get_monthly_selector,
+    get_range_selector,
+    send_excel
 )
 
 def register_callbacks(app):
@@ -22,8 +23,8 @@ def register_callbacks(app):
         if not stored_data:
             raise PreventUpdate
 
-        data = pd.read_json(StringIO(stored_data['data']), orient='split')
-        periods = sorted(data["Start_Date_time"].dt.to_period("M").astype(str).unique())
+        # Period list is precomputed at upload time
+        periods = stored_data['periods']
         return get_monthly_selector(periods) if analysis_type == 'Monthly' else get_range_selector(periods)
 
     @app.callback(
@@ -43,9 +44,11 @@ def register_callbacks(app):
         if not n_clicks or not stored_data:
             raise PreventUpdate
 
+        data = get_cached_dataframe(stored_data)
+        if data is None:
+            raise PreventUpdate
+
         try:
-            data = pd.read_json(StringIO(stored_data['data']), orient='split')
-            
             if analysis_type == 'Monthly':
                 period_value = period_values[0] if period_values else None
                 if not period_value:
@@ -70,17 +73,17 @@ def register_callbacks(app):
                 customdata=table["Details"]
             ))
 
-            # Calculate and add mean and median lines
-            freq_data = []
-            for freq, count in zip(table["Freq"], table["#Students"]):
-                if isinstance(freq, str):
-                    freq = int(freq.replace('>', ''))
-                freq_data.extend([freq] * count)
+            # Calculate and add mean and median lines from the binned counts;
+            # weighted stats avoid materializing one entry per student
+            freq_ints = np.array([int(f.replace('>', '')) if isinstance(f, str) else f
+                                  for f in table["Freq"]])
+            counts = table["#Students"].to_numpy()
+            total = counts.sum()
+
+            if total > 0:
+                mean_val = (freq_ints * counts).sum() / total
+                median_val = freq_ints[np.searchsorted(counts.cumsum(), total // 2, side='right')]
 
-            if freq_data:
-                mean_val = sum(freq_data) / len(freq_data)
-                median_val = sorted(freq_data)[len(freq_data)//2]
-                
                 fig.add_vline(x=mean_val, line_dash="dash", line_color="red",
                              annotation_text=f"Mean: {mean_val:.2f}",
                              annotation_position="top right",
@@ -115,10 +118,10 @@ def register_callbacks(app):
                 ),
                 html.Tbody([
                     html.Tr([
-                        html.Td(row[col], className="p-3 border") 
-                        for col in table.columns
+                        html.Td(value, className="p-3 border")
+                        for value in row
                     ], className="hover:bg-gray-50")
-                    for _, row in table.iterrows()
+                    for row in table.to_numpy()
                 ])
             ], className="min-w-full divide-y divide-gray-200")
 
@@ -140,8 +143,11 @@ def register_callbacks(app):
         if not n_clicks or not stored_data:
             raise PreventUpdate
 
+        data = get_cached_dataframe(stored_data)
+        if data is None:
+            raise PreventUpdate
+
         try:
-            data = pd.read_json(StringIO(stored_data['data']), orient='split')
             if analysis_type == 'Monthly':
                 period_value = period_values[0] if period_values else None
                 if not period_value:
@@ -156,6 +162,6 @@ def register_callbacks(app):
             if table is None:
                 raise PreventUpdate
 
-            return dcc.send_data_frame(table.to_excel, "booking_frequency.xlsx", sheet_name="Frequency Analysis")
+            return send_excel(table, "booking_frequency.xlsx", sheet_name="Frequency Analysis", index=True)
         except Exception:
             raise PreventUpdate
\ No newline at end of file
@@ -1,10 +1,31 @@
-from dash import Input, Output, State, dcc
+from collections import OrderedDict
+
+from dash import Input, Output, State
 import pandas as pd
 import plotly.graph_objs as go
 from dash.exceptions import PreventUpdate
-from io import StringIO
 import dash
-import json
+
+from cache import dataframe_from_store, dataframe_to_store, get_cached_dataframe
+from utils import send_excel
+
+# Static portion of the booking figure layout; the callback only fills in
+# the dynamic title
+_STUDENT_LAYOUT = dict(
+    xaxis_title="Month",
+    yaxis_title="Number of Bookings",
+    height=500,
+    # Keep zoom/pan state across re-executes
+    uirevision='student-booking',
+    legend=dict(
+        yanchor="top",
+        y=-0.2,
+        xanchor="center",
+        x=0.5,
+        orientation="h"
+    ),
+    margin=dict(b=100)  # Add bottom margin for legend
+)
 
 def calculate_monthly_bookings(data, selected_students, start_date, end_date):
     """Calculate monthly bookings for selected students"""
@@ -12,39 +33,63 @@ def calculate_monthly_bookings(data, selected_students, start_date, end_date):
     start_date = pd.to_datetime(start_date + '-01')
     end_date = pd.to_datetime(end_date + '-01') + pd.offsets.MonthEnd(1)
     
-    # Generate all months in the range
-    all_months = pd.date_range(start=start_date, end=end_date, freq='MS')
-    all_months_str = all_months.strftime('%Y-%m').tolist()
-    
-    # Filter data by selected students and date range
-    data['YearMonth'] = data['Start_Date_time'].dt.strftime('%Y-%m')
-    filtered_data = data[
-        (data['Id_Person'].isin(selected_students)) &
-        (data['Start_Date_time'] >= start_date) &
-        (data['Start_Date_time'] <= end_date) &
-        (~data['Class_Name'].str.contains('Self Practice', case=False, na=False))
-    ]
-    
-    # Calculate bookings per student per month
-    bookings = filtered_data.groupby(['YearMonth', 'Id_Person', 'FirstName']).size().reset_index(name='Bookings')
-    
-    # Create a DataFrame with all combinations of months and students
-    all_combinations = pd.DataFrame([
-        (month, student_id, student_name)
-        for month in all_months_str
-        for student_id, student_name in filtered_data[['Id_Person', 'FirstName']].drop_duplicates().values
-    ], columns=['YearMonth', 'Id_Person', 'FirstName'])
+    # Generate all months in the range as Periods, matching the upload-time
+    # YearMonth column, so every month key below hashes as int64
+    all_months = pd.period_range(start=start_date, end=end_date, freq='M')
+
+    # Most selective predicate first: at most four students survive the isin
+    # slice, so the timestamp comparisons only scan their rows ("Self
+    # Practice" rows are already dropped at upload time)
+    selected = data.loc[data['Id_Person'].isin(selected_students)]
+    filtered_data = selected[selected['Start_Date_time'].between(start_date, end_date)]
     
-    # Merge with actual bookings and fill missing values with 0
+    # Calculate bookings per student per month; FirstName is functionally
+    # determined by Id_Person, so it stays out of the group key and is
+    # attached once through the combinations frame
+    bookings = filtered_data.groupby(['YearMonth', 'Id_Person'], observed=True, sort=False).size().reset_index(name='Bookings')
+
+    # Create a DataFrame with all combinations of months and students via a
+    # vectorized cross join instead of a Python double loop
+    students = filtered_data[['Id_Person', 'FirstName']].drop_duplicates()
+    all_combinations = pd.DataFrame({'YearMonth': all_months}).merge(students, how='cross')
+
+    # Merge with actual bookings and fill missing counts with 0 (only the
+    # Bookings column can come back NaN)
     result = pd.merge(
         all_combinations,
         bookings,
-        on=['YearMonth', 'Id_Person', 'FirstName'],
+        on=['YearMonth', 'Id_Person'],
         how='left'
-    ).fillna(0)
-    
+    ).fillna({'Bookings': 0})
+
+    # Month labels become strings only at the plotting/export boundary
+    result['YearMonth'] = result['YearMonth'].astype(str)
     return result
 
+# The student options depend only on the upload, and Dash re-fires the
+# dropdown callback on every page mount; cache them per upload key
+_STUDENT_OPTIONS_CACHE = OrderedDict()
+_STUDENT_OPTIONS_CACHE_SIZE = 4
+
+def get_student_options(df, stored_key):
+    """Build (and cache) the student dropdown options for an upload"""
+    if stored_key in _STUDENT_OPTIONS_CACHE:
+        _STUDENT_OPTIONS_CACHE.move_to_end(stored_key)
+        return _STUDENT_OPTIONS_CACHE[stored_key]
+
+    students = df[['Id_Person', 'FirstName']].drop_duplicates()
+    ids = students['Id_Person'].to_numpy()
+    names = students['FirstName'].to_numpy()
+    student_options = [
+        {'label': f"{name} ({pid})", 'value': pid}
+        for name, pid in zip(names, ids)
+    ]
+
+    _STUDENT_OPTIONS_CACHE[stored_key] = student_options
+    if len(_STUDENT_OPTIONS_CACHE) > _STUDENT_OPTIONS_CACHE_SIZE:
+        _STUDENT_OPTIONS_CACHE.popitem(last=False)
+    return student_options
+
 def register_monthly_booking_student_callbacks(app):
     """Register callbacks for monthly booking by student analysis"""
     
@@ -63,19 +108,16 @@ def register_monthly_booking_student_callbacks(app):
     def update_dropdowns(stored_data):
         if not stored_data:
             return [[], [], [], [], [], [], None, None, {'display': 'none'}]
-            
-        df = pd.read_json(StringIO(stored_data['data']), orient='split')
-        
-        # Prepare student options
-        students = df[['Id_Person', 'FirstName']].drop_duplicates()
-        student_options = [
-            {'label': f"{row['FirstName']} ({row['Id_Person']})", 
-             'value': row['Id_Person']} 
-            for _, row in students.iterrows()
-        ]
+
+        df = get_cached_dataframe(stored_data)
+        if df is None:
+            return [[], [], [], [], [], [], None, None, {'display': 'none'}]
         
-        # Prepare period options
-        periods = sorted(df['Start_Date_time'].dt.strftime('%Y-%m').unique())
+        # Prepare student options (cached per upload)
+        student_options = get_student_options(df, stored_data['key'])
+
+        # Prepare period options (precomputed at upload time)
+        periods = stored_data['periods']
         period_options = [{'label': p, 'value': p} for p in periods]
         
         return (student_options, student_options, student_options, student_options,
@@ -101,20 +143,27 @@ def register_monthly_booking_student_callbacks(app):
                     start_period, end_period):
         if not n_clicks or not stored_data:
             raise PreventUpdate
-            
+
+        df = get_cached_dataframe(stored_data)
+        if df is None:
+            raise PreventUpdate
+
         try:
             # Get selected students (remove None values)
             selected_students = [s for s in [student1, student2, student3, student4] if s]
             if not selected_students:
                 raise ValueError("Please select at least one student")
-                
+
             # Load data and calculate bookings
-            df = pd.read_json(StringIO(stored_data['data']), orient='split')
             bookings = calculate_monthly_bookings(df, selected_students, start_period, end_period)
             
             # Create figure
             fig = go.Figure()
-            
+
+            # Per-point text labels get expensive to serialize and render on
+            # long windows; beyond ~18 months hover carries the values
+            show_text = bookings['YearMonth'].nunique() <= 18
+
             # Add line for each student
             for student_id in selected_students:
                 student_data = bookings[bookings['Id_Person'] == student_id]
@@ -124,9 +173,10 @@ def register_monthly_booking_student_callbacks(app):
                     x=student_data['YearMonth'],
                     y=student_data['Bookings'],
                     name=f"{student_name} ({student_id})",
-                    mode='lines+markers+text',
-                    text=student_data['Bookings'].astype(int),
-                    textposition='top center'
+                    mode='lines+markers+text' if show_text else 'lines+markers',
+                    text=student_data['Bookings'].astype(int) if show_text else None,
+                    textposition='top center',
+                    hovertemplate='%{y} bookings<br>%{x}'
                 ))
             
             # Update layout
@@ -137,23 +187,13 @@ def register_monthly_booking_student_callbacks(app):
                     xanchor='center',
                     font=dict(size=20)
                 ),
-                xaxis_title="Month",
-                yaxis_title="Number of Bookings",
-                height=500,
-                legend=dict(
-                    yanchor="top",
-                    y=-0.2,
-                    xanchor="center",
-                    x=0.5,
-                    orientation="h"
-                ),
-                margin=dict(b=100)  # Add bottom margin for legend
+                **_STUDENT_LAYOUT
             )
             
             return (
                 fig, {'display': 'block'},
                 "Analysis completed successfully", "text-green-600",
-                bookings.to_json(date_format='iso', orient='split')
+                dataframe_to_store(bookings)
             )
             
         except Exception as e:
@@ -166,35 +206,20 @@ def register_monthly_booking_student_callbacks(app):
     @app.callback(
         Output("download-student-xlsx", "data"),
         Input("export-student-btn", "n_clicks"),
-        [State('shared-stored-data', 'data'),
-         State('student-selector-1', 'value'),
-         State('student-selector-2', 'value'),
-         State('student-selector-3', 'value'),
-         State('student-selector-4', 'value'),
-         State('start-period-student', 'value'),
-         State('end-period-student', 'value')],
+        State("chart-data-student", "data"),
         prevent_initial_call=True
     )
-    def export_chart_data(n_clicks, stored_data, student1, student2, student3, student4,
-                         start_period, end_period):
-        if not n_clicks or not stored_data:
+    def export_chart_data(n_clicks, chart_data):
+        if not n_clicks or not chart_data:
             raise PreventUpdate
-        
+
         try:
-            # Get selected students (remove None values)
-            selected_students = [s for s in [student1, student2, student3, student4] if s]
-            if not selected_students:
-                raise PreventUpdate
-                
-            # Load data and calculate bookings
-            df = pd.read_json(StringIO(stored_data['data']), orient='split')
-            bookings = calculate_monthly_bookings(df, selected_students, start_period, end_period)
-            
-            return dcc.send_data_frame(
-                bookings.to_excel,
+            # Reuse the frame the execute click already computed
+            bookings = dataframe_from_store(chart_data)
+            return send_excel(
+                bookings,
                 "monthly_booking_by_student.xlsx",
-                sheet_name="Student Bookings",
-                index=False
+                sheet_name="Student Bookings"
             )
         except Exception:
             raise PreventUpdate
\ No newline at end of file
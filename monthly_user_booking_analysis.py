@@ -1,10 +1,51 @@
 from dash import html, dcc, Input, Output, State, callback
+import numpy as np
 import pandas as pd
 import plotly.graph_objs as go
 from dash.exceptions import PreventUpdate
-from io import StringIO
 import dash
 
+from cache import dataframe_from_store, dataframe_to_store, get_cached_dataframe
+from utils import send_excel
+
+# Static portion of the analysis figure layout; the callback only fills in
+# the dynamic title
+_MONTHLY_LAYOUT = dict(
+    xaxis_title='Month',
+    yaxis=dict(
+        title='Number of Users',
+        side='left',
+        showgrid=True,
+        gridwidth=1,
+        gridcolor='rgba(0,0,0,0.1)'
+    ),
+    yaxis2=dict(
+        title='Total Bookings',
+        side='right',
+        overlaying='y',
+        showgrid=False
+    ),
+    height=600,
+    showlegend=True,
+    legend=dict(
+        x=1.05,
+        y=1,
+        xanchor='left',
+        yanchor='top',
+        bgcolor='rgba(255, 255, 255, 0.8)',
+        bordercolor='rgba(0, 0, 0, 0.2)',
+        borderwidth=1
+    ),
+    margin=dict(r=150),
+    plot_bgcolor='white',
+    paper_bgcolor='white',
+    xaxis=dict(
+        showgrid=True,
+        gridwidth=1,
+        gridcolor='rgba(0,0,0,0.1)'
+    )
+)
+
 def create_monthly_user_booking_layout(show_upload=True):
     return html.Div([
         html.H1("Students Booking at Least N Times Per Month", className="text-2xl font-bold mb-4"),
@@ -101,27 +142,32 @@ def create_monthly_user_booking_layout(show_upload=True):
     ], className="max-w-4xl mx-auto p-6")
 
 def calculate_monthly_users(data, thresholds):
-    """Calculate monthly user statistics based on booking thresholds"""
-    data = data.copy()
-    data.loc[:, "YearMonth"] = data["Start_Date_time"].dt.to_period("M")
-    booking_frequencies = data.groupby(["YearMonth", "Id_Person"]).size().reset_index(name="Bookings")
-    
-    results = []
-    for n in thresholds:
-        counts = (
-            booking_frequencies.groupby("YearMonth")["Bookings"]
-            .apply(lambda x: (x >= n).sum())
-            .reset_index(name=f"Users_>=_{n}")
-        )
-        counts["YearMonth"] = counts["YearMonth"].astype(str)
-        results.append(counts)
+    """Calculate monthly user statistics based on booking thresholds
 
-    merged_results = results[0]
-    for i in range(1, len(results)):
-        merged_results = pd.merge(merged_results, results[i], on="YearMonth", how="outer")
+    Relies on the YearMonth column precomputed at upload time, so no copy or
+    per-call period conversion is needed.
+    """
+    booking_frequencies = data.groupby(["YearMonth", "Id_Person"], observed=True).size().reset_index(name="Bookings")
     
-    merged_results = merged_results.rename(columns={"YearMonth": "Month"})
-    return merged_results
+    # Fused threshold-count kernel: a broadcast compare against all
+    # thresholds and one scatter-add over factorized month codes fill the
+    # (n_months, n_thresholds) matrix in a single pass
+    month_codes, months = pd.factorize(booking_frequencies["YearMonth"], sort=True)
+    hits = (booking_frequencies["Bookings"].to_numpy()[:, None] >= np.asarray(thresholds)).astype(np.int64)
+    counts = np.zeros((len(months), len(thresholds)), dtype=np.int64)
+    np.add.at(counts, month_codes, hits)
+
+    merged_results = pd.DataFrame(counts, columns=[f"Users_>=_{n}" for n in thresholds])
+    merged_results.insert(0, "Month", months.astype(str))
+
+    # Per-month booking totals fall out of the same codes, saving the caller
+    # a second groupby (and period conversion) over the raw frame
+    total_bookings = pd.Series(
+        np.bincount(month_codes, weights=booking_frequencies["Bookings"].to_numpy(),
+                    minlength=len(months)).astype(np.int64),
+        index=merged_results["Month"]
+    )
+    return merged_results, total_bookings
 
 def register_monthly_user_booking_callbacks(app):
     @app.callback(
@@ -135,9 +181,9 @@ def register_monthly_user_booking_callbacks(app):
     def update_period_dropdowns(stored_data):
         if not stored_data:
             return [], [], None, None, {'display': 'none'}
-            
-        df = pd.read_json(StringIO(stored_data['data']), orient='split')
-        periods = sorted(df["Start_Date_time"].dt.to_period("M").astype(str).unique())
+
+        # Period list is precomputed at upload time
+        periods = stored_data['periods']
         options = [{'label': p, 'value': p} for p in periods]
         
         return options, options, periods[0], periods[-1], {'display': 'block'}
@@ -160,40 +206,44 @@ def register_monthly_user_booking_callbacks(app):
                     threshold1, threshold2, threshold3):
         if not n_clicks or not stored_data:
             raise PreventUpdate
-            
+
+        df = get_cached_dataframe(stored_data)
+        if df is None:
+            raise PreventUpdate
+
         try:
-            df = pd.read_json(StringIO(stored_data['data']), orient='split')
-            
-            filtered_data = df[
-                (df["Start_Date_time"].dt.to_period("M").astype(str) >= start_period) &
-                (df["Start_Date_time"].dt.to_period("M").astype(str) <= end_period)
-            ]
-            
-            if "Class_Name" in filtered_data.columns:
-                filtered_data = filtered_data[~filtered_data["Class_Name"].str.contains("Self Practice", case=False, na=False)]
-            
+            # Compare int64 timestamps directly instead of casting every row
+            # to a Period and then to a string (twice)
+            start_ts = pd.Period(start_period, freq="M").start_time
+            end_ts = pd.Period(end_period, freq="M").end_time
+            # "Self Practice" rows are already dropped at upload time
+            filtered_data = df[df["Start_Date_time"].between(start_ts, end_ts)]
+
             thresholds = [t for t in [threshold1, threshold2, threshold3] if t > 0]
             if not thresholds:
                 raise ValueError("Please set at least one threshold greater than 0")
             
-            stats = calculate_monthly_users(filtered_data, thresholds)
-            total_bookings = filtered_data.groupby(filtered_data["Start_Date_time"].dt.to_period("M")).size()
-            total_bookings = total_bookings.reindex(stats["Month"], fill_value=0)
-            
+            stats, total_bookings = calculate_monthly_users(filtered_data, thresholds)
+
             export_data = stats.copy()
             export_data['Total_Bookings'] = total_bookings.values
             
             fig = go.Figure()
-            
+
+            # Per-point text labels get expensive to serialize and render on
+            # long windows; beyond ~18 months hover carries the values
+            show_text = len(stats) <= 18
+
             for n in thresholds:
                 column = f"Users_>=_{n}"
                 fig.add_trace(go.Scatter(
                     x=stats["Month"], 
                     y=stats[column],
-                    mode='lines+markers+text',
+                    mode='lines+markers+text' if show_text else 'lines+markers',
                     name=f'Users ≥ {n} Bookings',
-                    text=stats[column],
+                    text=stats[column] if show_text else None,
                     textposition='top center',
+                    hovertemplate='%{y} users<br>%{x}',
                     yaxis='y'
                 ))
             
@@ -203,8 +253,9 @@ def register_monthly_user_booking_callbacks(app):
                 name='Total Bookings',
                 opacity=0.3,
                 yaxis='y2',
-                text=total_bookings,
+                text=total_bookings if show_text else None,
                 textposition='outside',
+                hovertemplate='%{y} bookings<br>%{x}',
                 marker_color='rgb(64, 105, 225)'
             ))
             
@@ -215,43 +266,11 @@ def register_monthly_user_booking_callbacks(app):
                     xanchor='center',
                     font=dict(size=20)
                 ),
-                xaxis_title='Month',
-                yaxis=dict(
-                    title='Number of Users',
-                    side='left',
-                    showgrid=True,
-                    gridwidth=1,
-                    gridcolor='rgba(0,0,0,0.1)'
-                ),
-                yaxis2=dict(
-                    title='Total Bookings',
-                    side='right',
-                    overlaying='y',
-                    showgrid=False
-                ),
-                height=600,
-                showlegend=True,
-                legend=dict(
-                    x=1.05,
-                    y=1,
-                    xanchor='left',
-                    yanchor='top',
-                    bgcolor='rgba(255, 255, 255, 0.8)',
-                    bordercolor='rgba(0, 0, 0, 0.2)',
-                    borderwidth=1
-                ),
-                margin=dict(r=150),
-                plot_bgcolor='white',
-                paper_bgcolor='white',
-                xaxis=dict(
-                    showgrid=True,
-                    gridwidth=1,
-                    gridcolor='rgba(0,0,0,0.1)'
-                )
+                **_MONTHLY_LAYOUT
             )
             
             return (fig, {'display': 'block'}, "Analysis completed successfully", 
-                    "text-green-600", export_data.to_json(date_format='iso', orient='split'))
+                    "text-green-600", dataframe_to_store(export_data))
         
         except Exception as e:
             return dash.no_update, {'display': 'none'}, f"Error: {str(e)}", "text-red-600", None
@@ -267,10 +286,8 @@ def register_monthly_user_booking_callbacks(app):
             raise PreventUpdate
         
         try:
-            df = pd.read_json(StringIO(chart_data), orient='split')
-            return dcc.send_data_frame(df.to_excel, 
-                                     "monthly_booking_analysis.xlsx", 
-                                     sheet_name="Monthly Analysis",
-                                     index=False)
+            df = dataframe_from_store(chart_data)
+            return send_excel(df, "monthly_booking_analysis.xlsx",
+                              sheet_name="Monthly Analysis")
         except Exception:
             raise PreventUpdate
\ No newline at end of file
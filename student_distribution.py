@@ -1,13 +1,14 @@
+from collections import OrderedDict
+
 from dash import html, dcc, Input, Output, State
 from dash.exceptions import PreventUpdate
+import numpy as np
 import pandas as pd
-from io import StringIO
-import matplotlib.pyplot as plt
-from matplotlib_venn import venn3
-import re
 import base64
 import io
 
+from cache import get_cached_dataframe
+
 def create_student_distribution_layout(show_upload=True):
     return html.Div([
         dcc.Download(id="download-venn-excel"),
@@ -31,75 +32,97 @@ def create_student_distribution_layout(show_upload=True):
         ], className="flex space-x-4 mb-4"),
         
         html.Div(id='status-message-dist', className="mb-4"),
-        html.Div([
+        dcc.Store(id='venn-data'),
+        # Wrapping the results in dcc.Loading shows the spinner while the
+        # worker renders, instead of a frozen page
+        dcc.Loading(id="loading-dist", type="default", children=html.Div([
             html.Img(id='venn-diagram-img', style={'maxWidth': '600px', 'margin': '0 auto', 'display': 'block'}),
             html.Div(id='details-table', className="mt-4")
-        ], id='results-section-dist', style={'display': 'none'}),
-        
-        dcc.Loading(id="loading-dist", type="default",
-                   children=html.Div(id="loading-output-dist"))
+        ], id='results-section-dist', style={'display': 'none'}))
     ], className="max-w-7xl mx-auto p-6")
 
 def calculate_distribution(data, start_period, end_period):
-    data = data.copy()
     start_month = pd.Period(start_period, freq="M")
     end_month = pd.Period(end_period, freq="M")
     total_months = (pd.period_range(start_month, end_month, freq="M")).size
 
-    data["Start_Date_time"] = pd.to_datetime(data["Start_Date_time"])
-    
+    # Timestamp bounds replace the per-row Period construction and string
+    # casts the old mask ran twice; "Self Practice" rows are already dropped
+    # at upload time and Start_Date_time is parsed once in parse_contents,
+    # so no full-frame copy or re-parse is needed here
     filtered_data = data[
-        data["Cateory"].notna() & 
-        (data["Cateory"] != "Virgin") & 
-        (~data["Class_Name"].str.contains("Self Practice", na=False)) &
-        (data["Start_Date_time"].dt.to_period("M").astype(str) >= start_period) &
-        (data["Start_Date_time"].dt.to_period("M").astype(str) <= end_period)
+        data["Cateory"].notna() &
+        (data["Cateory"] != "Virgin") &
+        data["Start_Date_time"].between(start_month.start_time, end_month.end_time)
     ]
 
-    filtered_data["FirstName"] = filtered_data["FirstName"].apply(
-        lambda x: re.search(r'\((.*?)\)', x).group(1) if re.search(r'\((.*?)\)', x) else x
-    )
+    # Vectorized extract of the parenthesized nickname; rows without one
+    # keep the original name. assign() gives this slice its own column
+    # without copying the rest of the frame per callback
+    names = filtered_data["FirstName"]
+    extracted = names.str.extract(r'\((.*?)\)', expand=False)
+    filtered_data = filtered_data.assign(FirstName=extracted.where(extracted.notna(), names))
 
+    # One grouped unique() pass replaces three full-table boolean scans
     categories = ["Spin", "Sport", "Choreo"]
-    sets = {
-        cat: set(filtered_data[filtered_data["Cateory"] == cat]["Id_Person"]) 
-        for cat in categories
-    }
+    per_cat = filtered_data.groupby("Cateory", observed=True)["Id_Person"].unique()
+    sets = {cat: set(per_cat.get(cat, ())) for cat in categories}
 
-    filtered_data["Month"] = filtered_data["Start_Date_time"].dt.to_period("M")
+    # The upload-time YearMonth column already holds the month period
     bookings_per_student = (
-        filtered_data.groupby(["Id_Person", "Month"]).size().reset_index(name="Bookings")
+        filtered_data.groupby(["Id_Person", "YearMonth"], observed=True).size().reset_index(name="Bookings")
     )
-    total_bookings_per_student = (
-        bookings_per_student.groupby("Id_Person")["Bookings"].sum().to_dict()
+    # One vectorized division and round replaces the per-student Python
+    # loop; the dicts remain for the cheap lookups downstream
+    total_series = bookings_per_student.groupby("Id_Person", observed=True)["Bookings"].sum()
+    total_bookings_per_student = total_series.to_dict()
+    avg_bookings_per_month = (total_series / total_months).round(1).to_dict()
+
+    # Encode each student's membership as a 3-bit code (Spin<<2 | Sport<<1 |
+    # Choreo) and slice all seven regions from one pass, instead of nine
+    # Python set operations
+    membership = (
+        filtered_data.groupby(["Id_Person", "Cateory"], observed=True).size().unstack(fill_value=0) > 0
     )
-
-    avg_bookings_per_month = {
-        sid: round(total_bookings_per_student[sid] / total_months, 1)
-        for sid in total_bookings_per_student
-    }
-
-    sizes = {
-        "100": sets["Spin"] - sets["Sport"] - sets["Choreo"],
-        "010": sets["Sport"] - sets["Spin"] - sets["Choreo"],
-        "001": sets["Choreo"] - sets["Spin"] - sets["Sport"],
-        "110": (sets["Spin"] & sets["Sport"]) - sets["Choreo"],
-        "101": (sets["Spin"] & sets["Choreo"]) - sets["Sport"],
-        "011": (sets["Sport"] & sets["Choreo"]) - sets["Spin"],
-        "111": sets["Spin"] & sets["Sport"] & sets["Choreo"],
-    }
-
+    code = np.zeros(len(membership), dtype=np.uint8)
+    for bit, cat in enumerate(["Choreo", "Sport", "Spin"]):
+        if cat in membership.columns:
+            code |= membership[cat].to_numpy().astype(np.uint8) << bit
+    sizes = {key: set(membership.index[code == int(key, 2)]) for key in SUBSET_ORDER}
+
+    # Build the label map from numpy arrays; iterrows boxed every student
+    # into a Series
+    uniq = filtered_data.drop_duplicates(subset="Id_Person")[["Id_Person", "FirstName"]]
     student_labels = {
-        student["Id_Person"]: f"({student['Id_Person']}){student['FirstName']}-{total_bookings_per_student.get(student['Id_Person'], 0)}"
-        for _, student in filtered_data[["Id_Person", "FirstName"]].drop_duplicates().iterrows()
+        sid: f"({sid}){name}-{total_bookings_per_student.get(sid, 0)}"
+        for sid, name in zip(uniq["Id_Person"].to_numpy(), uniq["FirstName"].to_numpy())
     }
 
-    total_students = len(set().union(*sets.values()))
+    # Same count as unioning the category sets, in one hashed C pass
+    total_students = int(filtered_data["Id_Person"].nunique())
 
     return categories, sets, sizes, total_students, filtered_data, avg_bookings_per_month, total_bookings_per_student, student_labels
 
+# The 20x16 inch figure is expensive to allocate; reuse one across renders
+_VENN_FIG = None
+
+# Rendered diagrams keyed by (upload, window) so repeat Execute clicks skip
+# matplotlib entirely
+_VENN_CACHE = OrderedDict()
+_VENN_CACHE_SIZE = 32
+
 def generate_venn_diagram(categories, sets, sizes, total_students, start_period, end_period):
-    fig = plt.figure(figsize=(20, 16))
+    # Deferred imports: matplotlib adds hundreds of ms and ~50MB RSS to every
+    # worker at boot, and most sessions never render a Venn diagram
+    import matplotlib.pyplot as plt
+    from matplotlib_venn import venn3
+
+    global _VENN_FIG
+    if _VENN_FIG is None:
+        _VENN_FIG = plt.figure(figsize=(20, 16))
+    else:
+        plt.figure(_VENN_FIG.number)
+        _VENN_FIG.clf()
     gs = plt.GridSpec(2, 1, height_ratios=[6, 1], hspace=0.3)
     plt.subplot(gs[0])
 
@@ -141,50 +164,96 @@ def generate_venn_diagram(categories, sets, sizes, total_students, start_period,
 
     plt.tight_layout()
 
+    # WebP at dpi 120 is a fraction of the dpi-200 PNG payload (file size
+    # scales with dpi squared) and encodes faster
     img = io.BytesIO()
-    plt.savefig(img, format='png', bbox_inches='tight', dpi=200)
-    plt.close()
+    plt.savefig(img, format='webp', bbox_inches='tight', dpi=120)
     img.seek(0)
     return base64.b64encode(img.getvalue()).decode()
 
+def cached_venn_diagram(stored_key, categories, sets, sizes, total_students, start_period, end_period):
+    """Memoized generate_venn_diagram keyed on the upload and window"""
+    key = (stored_key, start_period, end_period)
+    if key in _VENN_CACHE:
+        _VENN_CACHE.move_to_end(key)
+        return _VENN_CACHE[key]
+
+    img_data = generate_venn_diagram(categories, sets, sizes, total_students, start_period, end_period)
+    _VENN_CACHE[key] = img_data
+    if len(_VENN_CACHE) > _VENN_CACHE_SIZE:
+        _VENN_CACHE.popitem(last=False)
+    return img_data
+
+SUBSET_ORDER = ["100", "010", "001", "110", "101", "011", "111"]
+SUBSET_NAMES = {
+    "100": "Spin",
+    "010": "Sport",
+    "001": "Choreo",
+    "110": "Spin, Sport",
+    "101": "Spin, Choreo",
+    "011": "Sport, Choreo",
+    "111": "Spin, Sport, Choreo"
+}
+
+def summarize_subsets(sizes, avg_bookings_per_month):
+    """Aggregate count, average and retention stats per Venn region
+
+    Four bincounts over region codes compute every per-region statistic in
+    branch-free numpy passes.
+    """
+    region = {subset: i for i, subset in enumerate(SUBSET_ORDER)}
+    codes = []
+    avgs = []
+    for subset, members in sizes.items():
+        codes.extend([region[subset]] * len(members))
+        avgs.extend(avg_bookings_per_month.get(sid, 0) for sid in members)
+    codes = np.asarray(codes, dtype=np.intp)
+    avgs = np.asarray(avgs, dtype=np.float64)
+
+    n_regions = len(SUBSET_ORDER)
+    count = np.bincount(codes, minlength=n_regions)
+    avg_sum = np.bincount(codes, weights=avgs, minlength=n_regions)
+    retained = avgs >= 2
+    ret_count = np.bincount(codes[retained], minlength=n_regions)
+    ret_sum = np.bincount(codes[retained], weights=avgs[retained], minlength=n_regions)
+
+    summary = {}
+    for subset, i in region.items():
+        if count[i] == 0:
+            continue
+        summary[subset] = {
+            "count": int(count[i]),
+            "avg_bookings": round(avg_sum[i] / count[i], 1),
+            "retention_pct": ret_count[i] / count[i] * 100,
+            "retention_avg": round(ret_sum[i] / ret_count[i], 1) if ret_count[i] else 0
+        }
+    return summary
+
 def create_details_table(filtered_data, sizes, total_students, avg_bookings_per_month, total_bookings_per_student, student_labels):
-    bookings_per_student = (
-        filtered_data.groupby(["Id_Person", "Month"]).size().reset_index(name="Bookings")
-    )
     table_data = []
-    categories = ["Spin", "Sport", "Choreo"]
     headers = ["#", "Category", "Percentage", "Avg/Month", "Student", "Retention %", "Avg Booking Retention"]
 
-    subset_order = ["100", "010", "001", "110", "101", "011", "111"]
-    subset_names = {
-        "100": "Spin",
-        "010": "Sport", 
-        "001": "Choreo",
-        "110": "Spin, Sport",
-        "101": "Spin, Choreo",
-        "011": "Sport, Choreo",
-        "111": "Spin, Sport, Choreo"
-    }
+    subset_stats = summarize_subsets(sizes, avg_bookings_per_month)
 
-    for idx, subset in enumerate(subset_order):
+    # Sort all labels once; each region below slices this shared order
+    sorted_ids = sorted(student_labels, key=student_labels.get)
+
+    for idx, subset in enumerate(SUBSET_ORDER):
         students = sizes[subset]
         if not students:
             continue
 
-        avg_bookings = round(sum(avg_bookings_per_month.get(sid, 0) for sid in students) / len(students), 1) if students else 0
-        retention_students = [sid for sid in students if avg_bookings_per_month.get(sid, 0) >= 2]
-        retention_pct = len(retention_students) / len(students) * 100 if students else 0
-        avg_booking_retention = round(sum(avg_bookings_per_month.get(sid, 0) for sid in retention_students) / len(retention_students), 1) if retention_students else 0
-        student_list = sorted([student_labels[sid] for sid in students])
+        stats = subset_stats[subset]
+        student_list = [student_labels[sid] for sid in sorted_ids if sid in students]
 
         table_data.append(html.Tr([
             html.Td(str(idx), className="border px-4 py-2"),
-            html.Td(subset_names[subset], className="border px-4 py-2"),
-            html.Td(f"{(len(students) / total_students * 100):.1f}%", className="border px-4 py-2 text-center"),
-            html.Td(f"{avg_bookings:.1f}", className="border px-4 py-2 text-center"),
+            html.Td(SUBSET_NAMES[subset], className="border px-4 py-2"),
+            html.Td(f"{(stats['count'] / total_students * 100):.1f}%", className="border px-4 py-2 text-center"),
+            html.Td(f"{stats['avg_bookings']:.1f}", className="border px-4 py-2 text-center"),
             html.Td(", ".join(student_list), className="border px-4 py-2"),
-            html.Td(f"{retention_pct:.1f}%", className="border px-4 py-2 text-center"),
-            html.Td(f"{avg_booking_retention:.1f}", className="border px-4 py-2 text-center")
+            html.Td(f"{stats['retention_pct']:.1f}%", className="border px-4 py-2 text-center"),
+            html.Td(f"{stats['retention_avg']:.1f}", className="border px-4 py-2 text-center")
         ]))
 
     return html.Table(
@@ -195,16 +264,12 @@ def create_details_table(filtered_data, sizes, total_students, avg_bookings_per_
         className="w-full border-collapse border"
     )
 
-def create_excel_export(categories, sets, sizes, total_students, filtered_data, avg_bookings_per_month, total_bookings_per_student, student_labels):
-    import pandas as pd
-    import io
-    from openpyxl import Workbook
-    from openpyxl.drawing.image import Image
-    import base64
-
-    # Create Excel writer object
+def create_excel_export(categories, sets, sizes, total_students, avg_bookings_per_month, student_labels):
+    # xlsxwriter is faster than building openpyxl's in-memory OOXML tree;
+    # no constant_memory mode, since pandas writes column-by-column and the
+    # row-flushing would silently truncate every column after the first
     output = io.BytesIO()
-    writer = pd.ExcelWriter(output, engine='openpyxl')
+    writer = pd.ExcelWriter(output, engine='xlsxwriter')
     
     # Create summary dataframe
     summary_data = []
@@ -219,33 +284,28 @@ def create_excel_export(categories, sets, sizes, total_students, filtered_data,
     summary_df = pd.DataFrame(summary_data)
     summary_df.to_excel(writer, sheet_name='Summary', index=False)
 
-    # Create detailed analysis dataframe
-    subset_order = ["100", "010", "001", "110", "101", "011", "111"]
-    subset_names = {
-        "100": "Spin", "010": "Sport", "001": "Choreo",
-        "110": "Spin, Sport", "101": "Spin, Choreo",
-        "011": "Sport, Choreo", "111": "Spin, Sport, Choreo"
-    }
+    # Create detailed analysis dataframe from the shared per-subset summary
+    subset_stats = summarize_subsets(sizes, avg_bookings_per_month)
+
+    # Sort all labels once; each region below slices this shared order
+    sorted_ids = sorted(student_labels, key=student_labels.get)
 
     details_data = []
-    for subset in subset_order:
+    for subset in SUBSET_ORDER:
         students = sizes[subset]
         if not students:
             continue
 
-        avg_bookings = round(sum(avg_bookings_per_month.get(sid, 0) for sid in students) / len(students), 1) if students else 0
-        retention_students = [sid for sid in students if avg_bookings_per_month.get(sid, 0) >= 2]
-        retention_pct = len(retention_students) / len(students) * 100 if students else 0
-        avg_booking_retention = round(sum(avg_bookings_per_month.get(sid, 0) for sid in retention_students) / len(retention_students), 1) if retention_students else 0
-        student_list = ", ".join(sorted([student_labels[sid] for sid in students]))
+        stats = subset_stats[subset]
+        student_list = ", ".join(student_labels[sid] for sid in sorted_ids if sid in students)
 
         details_data.append({
-            'Category': subset_names[subset],
-            'Students Count': len(students),
-            'Percentage': f"{(len(students) / total_students * 100):.1f}%",
-            'Avg Bookings/Month': avg_bookings,
-            'Retention %': f"{retention_pct:.1f}%",
-            'Avg Booking Retention': avg_booking_retention,
+            'Category': SUBSET_NAMES[subset],
+            'Students Count': stats['count'],
+            'Percentage': f"{(stats['count'] / total_students * 100):.1f}%",
+            'Avg Bookings/Month': stats['avg_bookings'],
+            'Retention %': f"{stats['retention_pct']:.1f}%",
+            'Avg Booking Retention': stats['retention_avg'],
             'Students': student_list
         })
 
@@ -268,8 +328,8 @@ def register_student_distribution_callbacks(app):
         if not stored_data:
             raise PreventUpdate
 
-        df = pd.read_json(StringIO(stored_data['data']), orient='split')
-        periods = sorted(df["Start_Date_time"].dt.to_period("M").astype(str).unique())
+        # Period list is precomputed at upload time
+        periods = stored_data['periods']
         options = [{'label': p, 'value': p} for p in periods]
 
         return options, options, periods[0], periods[-1]
@@ -277,22 +337,29 @@ def register_student_distribution_callbacks(app):
     @app.callback(
         Output("download-venn-excel", "data"),
         Input("export-venn-btn", "n_clicks"),
-        [State('shared-stored-data', 'data'),
-         State('start-period-dist', 'value'),
-         State('end-period-dist', 'value')],
+        State('venn-data', 'data'),
         prevent_initial_call=True
     )
-    def export_venn_to_excel(n_clicks, stored_data, start_period, end_period):
-        if not n_clicks or not stored_data:
+    def export_venn_to_excel(n_clicks, venn_data):
+        if not n_clicks or not venn_data:
             raise PreventUpdate
 
-        df = pd.read_json(StringIO(stored_data['data']), orient='split')
-        categories, sets, sizes, total_students, filtered_data, avg_bookings_per_month, total_bookings_per_student, student_labels = calculate_distribution(
-            df, start_period, end_period
-        )
+        # Name the file after the window that was actually executed, which
+        # may differ from the current dropdown values
+        start_period = venn_data['start_period']
+        end_period = venn_data['end_period']
+
+        # Rebuild the Execute click's result instead of re-running the
+        # whole distribution pipeline (dict keys survive the JSON round
+        # trip as list-of-pairs)
+        sets = {cat: set(ids) for cat, ids in venn_data['sets'].items()}
+        sizes = {subset: set(ids) for subset, ids in venn_data['sizes'].items()}
+        avg_bookings_per_month = dict(map(tuple, venn_data['avg_bookings']))
+        student_labels = dict(map(tuple, venn_data['student_labels']))
 
-        excel_data = create_excel_export(categories, sets, sizes, total_students, filtered_data, 
-                                       avg_bookings_per_month, total_bookings_per_student, student_labels)
+        excel_data = create_excel_export(venn_data['categories'], sets, sizes,
+                                         venn_data['total_students'],
+                                         avg_bookings_per_month, student_labels)
 
         return dcc.send_bytes(excel_data, f"venn_analysis_{start_period}_to_{end_period}.xlsx")
 
@@ -301,7 +368,8 @@ def register_student_distribution_callbacks(app):
          Output('details-table', 'children'),
          Output('results-section-dist', 'style'),
          Output('status-message-dist', 'children'),
-         Output('status-message-dist', 'className')],
+         Output('status-message-dist', 'className'),
+         Output('venn-data', 'data')],
         Input('execute-dist-btn', 'n_clicks'),
         [State('shared-stored-data', 'data'),
          State('start-period-dist', 'value'),
@@ -311,22 +379,39 @@ def register_student_distribution_callbacks(app):
         if not n_clicks or not stored_data:
             raise PreventUpdate
 
+        df = get_cached_dataframe(stored_data)
+        if df is None:
+            raise PreventUpdate
+
         try:
-            df = pd.read_json(StringIO(stored_data['data']), orient='split')
             categories, sets, sizes, total_students, filtered_data, avg_bookings_per_month, total_bookings_per_student, student_labels = calculate_distribution(
                 df, start_period, end_period
             )
 
-            img_data = generate_venn_diagram(categories, sets, sizes, total_students, start_period, end_period)
+            img_data = cached_venn_diagram(stored_data['key'], categories, sets, sizes,
+                                           total_students, start_period, end_period)
             table = create_details_table(filtered_data, sizes, total_students, avg_bookings_per_month, total_bookings_per_student, student_labels)
 
+            # Everything the Export click needs, in JSON-safe form
+            venn_data = {
+                'start_period': start_period,
+                'end_period': end_period,
+                'categories': categories,
+                'sets': {cat: list(ids) for cat, ids in sets.items()},
+                'sizes': {subset: list(ids) for subset, ids in sizes.items()},
+                'total_students': total_students,
+                'avg_bookings': list(avg_bookings_per_month.items()),
+                'student_labels': list(student_labels.items())
+            }
+
             return (
-                f'data:image/png;base64,{img_data}',
+                f'data:image/webp;base64,{img_data}',
                 table,
                 {'display': 'block'},
                 "Analysis completed successfully",
-                "text-green-600"
+                "text-green-600",
+                venn_data
             )
 
         except Exception as e:
-            return None, None, {'display': 'none'}, f"Error: {str(e)}", "text-red-600"
\ No newline at end of file
+            return None, None, {'display': 'none'}, f"Error: {str(e)}", "text-red-600", None
\ No newline at end of file
